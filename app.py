@@ -1,13 +1,21 @@
 import os
 import re
+import sys
+import time
 import requests
 import json
 import datetime
 import csv
 import base64
+import cProfile
+import pstats
+import marshal
+import threading
+import contextlib
 import pandas as pd
 import streamlit as st
 from io import StringIO
+from collections import Counter
 from dotenv import load_dotenv
 from msal import ConfidentialClientApplication
   
@@ -33,6 +41,11 @@ inbox_id = os.getenv("INBOX_FOLDER")
 veracore_id = os.getenv("VERACORE_USER")
 veracore_pass = os.getenv("VERACORE_PASS")
 
+# Turns on submission profiling by default (PROFILE_SUBMISSION=1 or streamlit run app.py -- --profile).
+# PROFILE_SUBMISSION=stacks or --profile-stacks selects collapsed stacks instead of cProfile
+profile_stacks_default = os.getenv("PROFILE_SUBMISSION") == "stacks" or "--profile-stacks" in sys.argv
+profile_default = profile_stacks_default or os.getenv("PROFILE_SUBMISSION") == "1" or "--profile" in sys.argv
+
 
 # Converts date to a string VeraCore can use
 def convert_date(date_string: str):
@@ -332,6 +345,141 @@ class ErrorObject:
         self.error_text = ""
 
 
+# Shared no-op context used for stages when profiling is off
+_NO_STAGE = contextlib.nullcontext()
+
+# Profiles one submit_orders run. When disabled every hook is a no-op.
+# The mode is either "cprofile" for pstats output or "stacks" for collapsed-stack output. They can't run together
+# because on Python 3.12+ cProfile records every thread, so it would mostly measure the sampler thread
+class SubmissionProfiler:
+    # Seconds between stack samples for the collapsed-stack output
+    sample_interval = 0.005
+
+    def __init__(self, enabled=False, mode="cprofile"):
+        self.enabled = enabled
+        self.mode = mode
+        self.profile = None
+        # Set when another profiler was already active and cProfile couldn't start
+        self.profile_unavailable = False
+        # Stage name -> [wall seconds, CPU seconds, calls]
+        self.stage_times = {}
+        self.total_wall = 0.0
+        self.total_cpu = 0.0
+        # Collapsed stack string -> number of samples
+        self.stack_counts = Counter()
+        self.stop_sampling = threading.Event()
+
+    # Times a named stage in wall and CPU seconds. Stages should not be nested
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_STAGE
+        return self.private_timed_stage(name)
+
+    @contextlib.contextmanager
+    def private_timed_stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            times = self.stage_times.setdefault(name, [0.0, 0.0, 0])
+            times[0] += time.perf_counter() - wall_start
+            times[1] += time.thread_time() - cpu_start
+            times[2] += 1
+
+    # Wraps the whole run with cProfile or a background stack sampler depending on the mode.
+    # On Python 3.12+ cProfile also records other threads, so work from other sessions running at the same time shows up in the stats
+    @contextlib.contextmanager
+    def run(self):
+        if not self.enabled:
+            yield
+            return
+
+        sampler = None
+        if self.mode == "stacks":
+            sampler = threading.Thread(target=self.private_sample_stacks, args=(threading.get_ident(),), daemon=True)
+            sampler.start()
+        else:
+            # Only one cProfile can be active per process, so only the stage times are kept if another one is running
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                self.profile = None
+                self.profile_unavailable = True
+
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+
+        try:
+            yield
+        finally:
+            self.total_wall = time.perf_counter() - wall_start
+            self.total_cpu = time.thread_time() - cpu_start
+
+            if self.profile is not None:
+                self.profile.disable()
+            if sampler is not None:
+                self.stop_sampling.set()
+                sampler.join()
+
+    # Records the stack of the profiled thread until the run finishes
+    def private_sample_stacks(self, thread_id):
+        while not self.stop_sampling.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            if stack:
+                self.stack_counts[";".join(reversed(stack))] += 1
+
+    # Returns the profile in the binary format pstats.Stats can load
+    def generate_pstats_bytes(self):
+        if self.profile is None:
+            return None
+        return marshal.dumps(pstats.Stats(self.profile).stats)
+
+    # Returns "frame;frame;frame count" lines for flame graph tools
+    def generate_collapsed_stacks(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stack_counts.items())
+
+    # Returns the top functions by cumulative time as text
+    def generate_stats_text(self, limit=25):
+        if self.profile is None:
+            return ""
+        stats_string = StringIO()
+        pstats.Stats(self.profile, stream=stats_string).sort_stats("cumulative").print_stats(limit)
+        return stats_string.getvalue()
+
+    # Per-stage wall vs CPU time. Waiting is wall time not spent on CPU (mostly network)
+    def generate_stage_df(self):
+        rows = []
+        staged_wall = 0.0
+        staged_cpu = 0.0
+
+        for name, (wall, cpu, calls) in self.stage_times.items():
+            rows.append((name, calls, wall, cpu, max(wall - cpu, 0.0)))
+            staged_wall += wall
+            staged_cpu += cpu
+
+        other_wall = max(self.total_wall - staged_wall, 0.0)
+        other_cpu = max(self.total_cpu - staged_cpu, 0.0)
+        rows.append(("other", None, other_wall, other_cpu, max(other_wall - other_cpu, 0.0)))
+        rows.append(("total", None, self.total_wall, self.total_cpu, max(self.total_wall - self.total_cpu, 0.0)))
+
+        stage_df = pd.DataFrame(rows, columns=["Stage", "Calls", "Wall (s)", "CPU (s)", "Waiting (s)"])
+
+        # Keeps call counts as integers with blanks for the other and total rows
+        return stage_df.astype({"Calls": pd.Int64Dtype()})
+
+# Default profiler passed when a run is not being profiled
+NO_PROFILER = SubmissionProfiler()
+
+
 # Gets authorization token for VeraCore REST API 
 def get_auth(user :str, passw : str):
     endpoint = 'https://wms.3plwinner.com/VeraCore/Public.Api/api/Login'
@@ -357,7 +505,7 @@ def get_auth(user :str, passw : str):
 
     return (auth_header, True)
 
-def change_version(orders : Orders, error_email : ErrorEmail, auth_header, error_obj : ErrorObject):
+def change_version(orders : Orders, error_email : ErrorEmail, auth_header, error_obj : ErrorObject, profiler : SubmissionProfiler = NO_PROFILER):
     st.warning(f"Calling change_version for order {orders.order_id}")
     auth_header["Content-Type"] = "application/json"
 
@@ -372,7 +520,8 @@ def change_version(orders : Orders, error_email : ErrorEmail, auth_header, error
     #st.subheader("VeraCore ShippingOrder API Request Payload")
     #st.code(json.dumps(payload, indent=2), language='json')
 
-    response = requests.post(endpoint, headers=auth_header, json=payload)
+    with profiler.stage("network"):
+        response = requests.post(endpoint, headers=auth_header, json=payload)
     #st.subheader("VeraCore API Response")
     #st.text(f"Status Code: {response.status_code}")
     #st.code(response.text, language='json')  # Use .code for formatting, or .text for raw outpu
@@ -380,10 +529,11 @@ def change_version(orders : Orders, error_email : ErrorEmail, auth_header, error
     if not(response.status_code == 200):
         # If error we want to add the offers to the error email
         error_email.add_offers(orders.offers)
-        try:
-            error_text = response.json().get("Error", response.text)
-        except Exception:
-            error_text = response.text
+        with profiler.stage("parse_response"):
+            try:
+                error_text = response.json().get("Error", response.text)
+            except Exception:
+                error_text = response.text
         st.error(f"Version update error: {error_text}")
         error_email.add_to_body(orders.order_id, error_text)
         write_to_log(f"Change version failed for {orders.order_id}:\n{error_text}")
@@ -396,29 +546,35 @@ def change_version(orders : Orders, error_email : ErrorEmail, auth_header, error
 
 
 # Makes API calls to create orders in VeraCore
-def create_orders(orders: Orders, error_email : ErrorEmail, error_obj: ErrorObject):
+def create_orders(orders: Orders, error_email : ErrorEmail, error_obj: ErrorObject, profiler : SubmissionProfiler = NO_PROFILER):
 
     # Needs to be text/xml to work
     headers = {
         "Content-Type" : "text/xml"
     }
 
-    response = requests.post("https://rhu335.veracore.com/pmomsws/OMS.asmx", headers=headers, data=orders.generate_order_xml())
+    with profiler.stage("generate_order_xml"):
+        order_xml = orders.generate_order_xml()
+
+    with profiler.stage("network"):
+        response = requests.post("https://rhu335.veracore.com/pmomsws/OMS.asmx", headers=headers, data=order_xml)
 
     if response.status_code > 299:
         # If error, we want to add the offers to the error email
         error_email.add_offers(orders.offers)
-        error_text = response.text
-        split_string = error_text.split("System.Exception:")[-1]
-        api_error = split_string.split("at")[0]
+        with profiler.stage("parse_response"):
+            error_text = response.text
+            split_string = error_text.split("System.Exception:")[-1]
+            api_error = split_string.split("at")[0]
 
         # If the order already exists you just change the selected version on the order
         if "already exists" in api_error:
-            auth_header, was_successful = get_auth(orders.user_id, orders.password)
+            with profiler.stage("network"):
+                auth_header, was_successful = get_auth(orders.user_id, orders.password)
             
             # If the auth was successful try to change the versions
             if was_successful:
-                change_version(orders,error_email,auth_header, error_obj)
+                change_version(orders,error_email,auth_header, error_obj, profiler)
             else:
                 error_obj.is_error = True
                 error_obj.error_text = "Invalid Credentials"
@@ -433,18 +589,24 @@ def create_orders(orders: Orders, error_email : ErrorEmail, error_obj: ErrorObje
             error_obj.error_text = "There was an issue with one or more of your orders. The orders have now been sent to IT to investigate and upload."
     # Otherwise adding was successful and follow the same path
     else:
-        auth_header, was_successful = get_auth(orders.user_id, orders.password)
+        with profiler.stage("network"):
+            auth_header, was_successful = get_auth(orders.user_id, orders.password)
 
         if was_successful:
-            change_version(orders,error_email,auth_header, error_obj)
+            change_version(orders,error_email,auth_header, error_obj, profiler)
         else:
             error_obj.is_error = True
             error_obj.error_text = "Invalid Credentials"
 
 # Call back function/button submit function. Returns error email
-def submit_orders(uploaded_df, error_obj : ErrorObject):
+def submit_orders(uploaded_df, error_obj : ErrorObject, profiler : SubmissionProfiler = NO_PROFILER):
+    with profiler.run():
+        return private_submit_orders(uploaded_df, error_obj, profiler)
 
-    api_df = process_df(uploaded_df)
+def private_submit_orders(uploaded_df, error_obj : ErrorObject, profiler : SubmissionProfiler):
+
+    with profiler.stage("process_df"):
+        api_df = process_df(uploaded_df)
 
     # Get tuples to iterate through
     order_tuples = api_df.itertuples()
@@ -465,13 +627,13 @@ def submit_orders(uploaded_df, error_obj : ErrorObject):
         if orders.order_id == order[0]:
             orders.add_to_offers(order)
         else:    
-            create_orders(orders,error_email, error_obj)
+            create_orders(orders,error_email, error_obj, profiler)
 
             # Create new orders object after creating order
             orders = Orders(user_id,passer,order[0])
             orders.add_to_offers(order)
         
-    create_orders(orders, error_email, error_obj)
+    create_orders(orders, error_email, error_obj, profiler)
     
     return error_email
 
@@ -624,6 +786,17 @@ if not(uploaded_file == None):
 
         st.text("")
         st.text("")
+        st.text("")
+        # Lets the user capture a profile of this submission
+        profile_run = st.checkbox("Profile this submission", value=profile_default)
+        profile_mode = "cprofile"
+
+        if profile_run:
+            profile_format = st.radio("Profile format", ["cProfile stats", "Collapsed stacks"],
+                                      index=1 if profile_stacks_default else 0, horizontal=True)
+            if profile_format == "Collapsed stacks":
+                profile_mode = "stacks"
+
         st.text("")
         # Generate boolean when the button is clicked
         ready = st.button("Submit")
@@ -633,7 +806,27 @@ if not(uploaded_file == None):
         
         if ready:
             # If button is clicked try submitting orders
-            error_email = submit_orders(uploaded_df, error_obj)
+            profiler = SubmissionProfiler(enabled=profile_run, mode=profile_mode)
+            error_email = submit_orders(uploaded_df, error_obj, profiler)
+
+            # Show the stage breakdown and profile downloads
+            if profiler.enabled:
+                st.text("")
+                st.text("Submission Profile")
+                st.dataframe(profiler.generate_stage_df())
+
+                if profiler.mode == "stacks":
+                    st.download_button("Download collapsed stacks", data=profiler.generate_collapsed_stacks(),
+                                       file_name="submit_orders.collapsed.txt", mime="text/plain", on_click="ignore")
+                elif profiler.profile_unavailable:
+                    st.warning("cProfile was unavailable for this run because another profiler was already active. Only the stage times were captured.",
+                               icon=":material/warning:")
+                else:
+                    st.download_button("Download cProfile stats", data=profiler.generate_pstats_bytes(), file_name="submit_orders.prof",
+                                       mime="application/octet-stream", on_click="ignore")
+
+                    with st.expander("Top functions by cumulative time"):
+                        st.code(profiler.generate_stats_text())
 
             # If an error was found show error text and generate email with the orders
             if error_obj.is_error: